@@ -126,11 +126,13 @@ class ClinicalProcedure(Document):
 			consumption_details = False
 			customer = frappe.db.get_value("Patient", self.patient, "customer")
 			if customer:
+				price_list = price_list_currency = None
 				for item in self.items:
 					if item.invoice_separately_as_consumables:
-						price_list, price_list_currency = frappe.db.get_values(
-							"Price List", {"selling": 1}, ["name", "currency"]
-						)[0]
+						if not price_list:
+							price_list, price_list_currency = frappe.db.get_values(
+								"Price List", {"selling": 1}, ["name", "currency"]
+							)[0]
 						args = {
 							"doctype": "Sales Invoice",
 							"item_code": item.item_code,
@@ -154,10 +156,12 @@ class ClinicalProcedure(Document):
 
 				if consumable_total_amount > 0:
 					frappe.db.set_value(
-						"Clinical Procedure", self.name, "consumable_total_amount", consumable_total_amount
-					)
-					frappe.db.set_value(
-						"Clinical Procedure", self.name, "consumption_details", consumption_details
+						"Clinical Procedure",
+						self.name,
+						{
+							"consumable_total_amount": consumable_total_amount,
+							"consumption_details": consumption_details,
+						},
 					)
 			else:
 				frappe.throw(
@@ -212,6 +216,7 @@ class ClinicalProcedure(Document):
 		stock_entry.to_warehouse = self.warehouse
 		stock_entry.company = self.company
 		expense_account = get_account(None, "expense_account", "Healthcare Settings", self.company)
+		cost_center = frappe.get_cached_value("Company", self.company, "cost_center")
 		for item in self.items:
 			if item.qty > item.actual_qty:
 				se_child = stock_entry.append("items")
@@ -224,7 +229,6 @@ class ClinicalProcedure(Document):
 				# in stock uom
 				se_child.transfer_qty = flt(item.transfer_qty)
 				se_child.conversion_factor = flt(item.conversion_factor)
-				cost_center = frappe.get_cached_value("Company", self.company, "cost_center")
 				se_child.cost_center = cost_center
 				se_child.expense_account = expense_account
 		if submit:
@@ -290,9 +294,9 @@ def make_stock_entry(doc):
 	stock_entry.from_warehouse = doc.warehouse
 	stock_entry.company = doc.company
 	expense_account = get_account(None, "expense_account", "Healthcare Settings", doc.company)
+	cost_center = frappe.get_cached_value("Company", doc.company, "cost_center")
 
 	for item_line in stock_entry.items:
-		cost_center = frappe.get_cached_value("Company", doc.company, "cost_center")
 		item_line.cost_center = cost_center
 		item_line.expense_account = expense_account
 
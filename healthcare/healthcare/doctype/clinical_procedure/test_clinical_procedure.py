@@ -5,7 +5,12 @@
 
 import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import getdate
 
+from healthcare.healthcare.doctype.healthcare_settings.healthcare_settings import (
+	get_income_account,
+	get_receivable_account,
+)
 from healthcare.healthcare.doctype.patient_appointment.test_patient_appointment import (
 	create_clinical_procedure_template,
 	create_healthcare_docs,
@@ -49,6 +54,77 @@ class TestClinicalProcedure(FrappeTestCase):
 		# check consumption
 		self.assertTrue(frappe.db.exists("Stock Entry", result))
 
+	def test_invoiced_flags(self):
+		patient, practitioner = create_healthcare_docs()
+		procedure_template = create_clinical_procedure_template()
+		procedure = create_procedure(procedure_template, patient, practitioner)
+		consumable = create_consumable()
+		consumable_item = frappe.db.get_single_value(
+			"Healthcare Settings", "clinical_procedure_consumable_item"
+		)
+		self.addCleanup(
+			frappe.db.set_single_value,
+			"Healthcare Settings",
+			"clinical_procedure_consumable_item",
+			consumable_item,
+		)
+		frappe.db.set_single_value(
+			"Healthcare Settings", "clinical_procedure_consumable_item", consumable.item_code
+		)
+
+		sales_invoice = create_sales_invoice(
+			patient, procedure, [procedure_template.item, consumable.item_code]
+		)
+		sales_invoice.submit()
+		self.assertEqual(frappe.db.get_value("Clinical Procedure", procedure.name, "invoiced"), 1)
+		self.assertEqual(
+			frappe.db.get_value("Clinical Procedure", procedure.name, "consumption_invoiced"), 1
+		)
+
+		sales_invoice.cancel()
+		self.assertEqual(frappe.db.get_value("Clinical Procedure", procedure.name, "invoiced"), 0)
+		self.assertEqual(
+			frappe.db.get_value("Clinical Procedure", procedure.name, "consumption_invoiced"), 0
+		)
+
+	def test_invoice_duplicate_reference(self):
+		patient, practitioner = create_healthcare_docs()
+		procedure_template = create_clinical_procedure_template()
+		procedure = create_procedure(procedure_template, patient, practitioner)
+
+		sales_invoice = create_sales_invoice(
+			patient, procedure, [procedure_template.item, procedure_template.item]
+		)
+		self.assertRaises(frappe.ValidationError, sales_invoice.submit)
+		self.assertEqual(frappe.db.get_value("Clinical Procedure", procedure.name, "invoiced"), 0)
+
+
+def create_sales_invoice(patient, procedure, items):
+	sales_invoice = frappe.new_doc("Sales Invoice")
+	sales_invoice.patient = patient
+	sales_invoice.customer = frappe.db.get_value("Patient", patient, "customer")
+	sales_invoice.due_date = getdate()
+	sales_invoice.company = "_Test Company"
+	sales_invoice.debit_to = get_receivable_account("_Test Company")
+	for item in items:
+		sales_invoice.append(
+			"items",
+			{
+				"item_code": item,
+				"qty": 1,
+				"uom": "Nos",
+				"conversion_factor": 1,
+				"income_account": get_income_account(None, "_Test Company"),
+				"rate": 100,
+				"amount": 100,
+				"reference_dt": procedure.doctype,
+				"reference_dn": procedure.name,
+			},
+		)
+	sales_invoice.set_missing_values()
+	sales_invoice.save()
+	return sales_invoice
+
 
 def create_consumable():
 	if frappe.db.exists("Item", "Syringe"):
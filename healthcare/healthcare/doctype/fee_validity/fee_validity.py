@@ -105,16 +105,15 @@ def check_fee_validity(appointment, date=None, practitioner=None):
 def manage_fee_validity(appointment):
 	free_follow_ups = frappe.db.get_single_value("Healthcare Settings", "enable_free_follow_ups")
 	# Update fee validity dates when rescheduling an invoiced appointment
-	if free_follow_ups:
-		invoiced_fee_validity = frappe.db.exists(
-			"Fee Validity", {"patient_appointment": appointment.name}
+	if free_follow_ups and appointment.invoiced:
+		invoiced_fee_validity = frappe.db.get_value(
+			"Fee Validity", {"patient_appointment": appointment.name}, ["name", "start_date"], as_dict=1
 		)
-		if invoiced_fee_validity and appointment.invoiced:
-			start_date = frappe.db.get_value("Fee Validity", invoiced_fee_validity, "start_date")
-			if getdate(appointment.appointment_date) != start_date:
+		if invoiced_fee_validity:
+			if getdate(appointment.appointment_date) != invoiced_fee_validity.start_date:
 				frappe.db.set_value(
 					"Fee Validity",
-					invoiced_fee_validity,
+					invoiced_fee_validity.name,
 					{
 						"start_date": appointment.appointment_date,
 						"valid_till": getdate(appointment.appointment_date)
@@ -127,13 +126,14 @@ def manage_fee_validity(appointment):
 	fee_validity = check_fee_validity(appointment)
 
 	if fee_validity:
-		exists = frappe.db.exists("Fee Validity Reference", {"appointment": appointment.name})
 		if appointment.status == "Cancelled" and fee_validity.visited > 0:
 			fee_validity.visited -= 1
 			frappe.db.delete("Fee Validity Reference", {"appointment": appointment.name})
 		elif fee_validity.status != "Active":
 			return
-		elif appointment.name != fee_validity.patient_appointment and not exists:
+		elif appointment.name != fee_validity.patient_appointment and not frappe.db.exists(
+			"Fee Validity Reference", {"appointment": appointment.name}
+		):
 			fee_validity.visited += 1
 			fee_validity.append("ref_appointments", {"appointment": appointment.name})
 		fee_validity.save(ignore_permissions=True)
@@ -93,6 +93,35 @@ def get_income_account(practitioner, company):
 	return frappe.get_cached_value("Company", company, "default_income_account")
 
 
+def get_income_accounts(practitioners, company):
+	# resolve income accounts for many practitioners, same precedence as get_income_account
+	practitioners = list({practitioner for practitioner in practitioners if practitioner})
+	if not practitioners:
+		return {}
+
+	# rows come newest first, keep the first per practitioner like get_value does
+	income_accounts = {}
+	for practitioner, account in frappe.get_all(
+		"Party Account",
+		filters={
+			"parenttype": "Healthcare Practitioner",
+			"parent": ["in", practitioners],
+			"company": company,
+		},
+		fields=["parent", "account"],
+		as_list=True,
+	):
+		income_accounts.setdefault(practitioner, account)
+
+	missing = [practitioner for practitioner in practitioners if not income_accounts.get(practitioner)]
+	if missing:
+		default_income_account = get_income_account(None, company)
+		for practitioner in missing:
+			income_accounts[practitioner] = default_income_account
+
+	return income_accounts
+
+
 def get_account(parent_type, parent_field, parent, company):
 	if parent_type:
 		return frappe.db.get_value(
@@ -3,8 +3,44 @@
 # See license.txt
 
 
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, now_datetime
+
+from healthcare.healthcare.doctype.healthcare_settings.healthcare_settings import (
+	get_income_account,
+	get_income_accounts,
+)
+from healthcare.healthcare.doctype.patient_appointment.test_patient_appointment import (
+	create_practitioner,
+)
 
 
 class TestHealthcareSettings(FrappeTestCase):
-	pass
+	def test_income_accounts_with_duplicate_company_rows(self):
+		practitioner = frappe.get_doc("Healthcare Practitioner", create_practitioner())
+		older_account, newer_account = frappe.get_all(
+			"Account",
+			filters={"company": "_Test Company", "root_type": "Income", "is_group": 0},
+			pluck="name",
+			limit=2,
+		)
+		practitioner.set("accounts", [])
+		practitioner.append("accounts", {"company": "_Test Company", "account": older_account})
+		practitioner.append("accounts", {"company": "_Test Company", "account": newer_account})
+		practitioner.save(ignore_permissions=True)
+
+		# both rows are saved together, age the first one to order them
+		yesterday = add_days(now_datetime(), -1)
+		frappe.db.set_value(
+			"Party Account",
+			practitioner.accounts[0].name,
+			{"creation": yesterday, "modified": yesterday},
+			update_modified=False,
+		)
+
+		self.assertEqual(get_income_account(practitioner.name, "_Test Company"), newer_account)
+		self.assertEqual(
+			get_income_accounts([practitioner.name], "_Test Company"),
+			{practitioner.name: newer_account},
+		)
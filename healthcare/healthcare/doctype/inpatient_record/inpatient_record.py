@@ -7,7 +7,6 @@ import json
 
 import frappe
 from frappe import _
-from frappe.desk.reportview import get_match_cond
 from frappe.model.document import Document
 from frappe.utils import get_datetime, get_link_to_form, getdate, now_datetime, today
 
@@ -17,33 +16,16 @@ from healthcare.healthcare.utils import validate_nursing_tasks
 
 class InpatientRecord(Document):
 	def after_insert(self):
-		frappe.db.set_value("Patient", self.patient, "inpatient_record", self.name)
-		frappe.db.set_value("Patient", self.patient, "inpatient_status", self.status)
+		inpatient_details = {"inpatient_record": self.name, "inpatient_status": self.status}
+		frappe.db.set_value("Patient", self.patient, inpatient_details)
 
 		if self.admission_encounter:  # Update encounter
-			frappe.db.set_value(
-				"Patient Encounter",
-				self.admission_encounter,
-				{"inpatient_record": self.name, "inpatient_status": self.status},
-			)
+			frappe.db.set_value("Patient Encounter", self.admission_encounter, inpatient_details)
 
+			# update all submitted orders of the encounter by filter, one query per doctype
 			filters = {"order_group": self.admission_encounter, "docstatus": 1}
-			medication_requests = frappe.get_all("Medication Request", filters, ["name"])
-			service_requests = frappe.get_all("Service Request", filters, ["name"])
-
-			for service_request in service_requests:
-				frappe.db.set_value(
-					"Service Request",
-					service_request.name,
-					{"inpatient_record": self.name, "inpatient_status": self.status},
-				)
-
-			for medication_request in medication_requests:
-				frappe.db.set_value(
-					"Medication Request",
-					medication_request.name,
-					{"inpatient_record": self.name, "inpatient_status": self.status},
-				)
+			frappe.db.set_value("Service Request", filters, inpatient_details)
+			frappe.db.set_value("Medication Request", filters, inpatient_details)
 
 		if self.admission_nursing_checklist_template:
 			NursingTask.create_nursing_tasks_from_template(
@@ -60,8 +42,9 @@ class InpatientRecord(Document):
 			)
 
 	def validate_dates(self):
-		if (getdate(self.expected_discharge) < getdate(self.scheduled_date)) or (
-			getdate(self.discharge_ordered_date) < getdate(self.scheduled_date)
+		scheduled_date = getdate(self.scheduled_date)
+		if (getdate(self.expected_discharge) < scheduled_date) or (
+			getdate(self.discharge_ordered_date) < scheduled_date
 		):
 			frappe.throw(_("Expected and Discharge dates cannot be less than Admission Schedule date"))
 
@@ -76,19 +59,21 @@ class InpatientRecord(Document):
 				)
 
 	def validate_already_scheduled_or_admitted(self):
-		query = """
-			select name, status
-			from `tabInpatient Record`
-			where (status = 'Admitted' or status = 'Admission Scheduled')
-			and name != %(name)s and patient = %(patient)s
-			"""
-
-		ip_record = frappe.db.sql(query, {"name": self.name, "patient": self.patient}, as_dict=1)
+		ip_record = frappe.db.get_value(
+			"Inpatient Record",
+			{
+				"patient": self.patient,
+				"status": ["in", ["Admitted", "Admission Scheduled"]],
+				"name": ["!=", self.name],
+			},
+			["name", "status"],
+			as_dict=1,
+		)
 
 		if ip_record:
 			msg = _(
-				("Already {0} Patient {1} with Inpatient Record ").format(ip_record[0].status, self.patient)
-				+ """ <b><a href="/app/Form/Inpatient Record/{0}">{0}</a></b>""".format(ip_record[0].name)
+				("Already {0} Patient {1} with Inpatient Record ").format(ip_record.status, self.patient)
+				+ """ <b><a href="/app/Form/Inpatient Record/{0}">{0}</a></b>""".format(ip_record.name)
 			)
 			frappe.throw(msg)
 
@@ -108,6 +93,10 @@ class InpatientRecord(Document):
 			transfer_patient(self, service_unit, check_in)
 
 
+def on_doctype_update():
+	frappe.db.add_index("Inpatient Record", ["patient", "status"])
+
+
 @frappe.whitelist()
 def schedule_inpatient(args):
 	admission_order = json.loads(args)  # admission order via Encounter
@@ -124,7 +113,17 @@ def schedule_inpatient(args):
 	set_details_from_ip_order(inpatient_record, admission_order)
 
 	# Patient details
-	patient = frappe.get_doc("Patient", admission_order["patient"])
+	patient = frappe.db.get_value(
+		"Patient",
+		admission_order["patient"],
+		["name", "patient_name", "sex", "blood_group", "dob", "mobile", "email", "phone"],
+		as_dict=1,
+	)
+	if not patient:
+		frappe.throw(
+			_("Patient {0} not found").format(admission_order["patient"]), frappe.DoesNotExistError
+		)
+
 	inpatient_record.patient = patient.name
 	inpatient_record.patient_name = patient.patient_name
 	inpatient_record.gender = patient.sex
@@ -202,21 +201,30 @@ def set_details_from_ip_order(inpatient_record, ip_order):
 
 
 def set_ip_child_records(inpatient_record, inpatient_record_child, encounter_child):
+	child_doctype = inpatient_record.meta.get_field(inpatient_record_child).options
+	fieldnames = tuple(df.fieldname for df in frappe.get_meta(child_doctype).get("fields"))
 	for item in encounter_child:
 		table = inpatient_record.append(inpatient_record_child)
-		for df in table.meta.get("fields"):
-			table.set(df.fieldname, item.get(df.fieldname))
+		for fieldname in fieldnames:
+			table.set(fieldname, item.get(fieldname))
 
 
 def check_out_inpatient(inpatient_record):
 	if inpatient_record.inpatient_occupancies:
+		vacated_service_units = []
 		for inpatient_occupancy in inpatient_record.inpatient_occupancies:
 			if inpatient_occupancy.left != 1:
 				inpatient_occupancy.left = True
 				inpatient_occupancy.check_out = now_datetime()
-				frappe.db.set_value(
-					"Healthcare Service Unit", inpatient_occupancy.service_unit, "occupancy_status", "Vacant"
-				)
+				vacated_service_units.append(inpatient_occupancy.service_unit)
+		set_service_units_vacant(vacated_service_units)
+
+
+def set_service_units_vacant(service_units):
+	if service_units:
+		frappe.db.set_value(
+			"Healthcare Service Unit", {"name": ["in", service_units]}, "occupancy_status", "Vacant"
+		)
 
 
 def discharge_patient(inpatient_record):
@@ -241,15 +249,10 @@ def validate_inpatient_invoicing(inpatient_record):
 	if pending_invoices:
 		message = _("Cannot mark Inpatient Record as Discharged since there are unbilled services. ")
 
-		formatted_doc_rows = ""
-
-		for doctype, docnames in pending_invoices.items():
-			formatted_doc_rows += """
-				<td>{0}</td>
-				<td>{1}</td>
-			</tr>""".format(
-				doctype, docnames
-			)
+		formatted_doc_rows = "".join(
+			f"<tr><td>{doctype}</td><td>{docnames}</td></tr>"
+			for doctype, docnames in pending_invoices.items()
+		)
 
 		message += """
 			<table class='table'>
@@ -269,16 +272,20 @@ def validate_inpatient_invoicing(inpatient_record):
 def get_pending_invoices(inpatient_record):
 	pending_invoices = {}
 	if inpatient_record.inpatient_occupancies:
-		service_unit_names = False
+		service_unit_names = []
+		billable_service_units = get_billable_service_units(
+			{
+				inpatient_occupancy.service_unit
+				for inpatient_occupancy in inpatient_record.inpatient_occupancies
+				if not inpatient_occupancy.invoiced
+			}
+		)
 		for inpatient_occupancy in inpatient_record.inpatient_occupancies:
 			if not inpatient_occupancy.invoiced:
-				if is_service_unit_billable(inpatient_occupancy.service_unit):
-					if service_unit_names:
-						service_unit_names += ", " + inpatient_occupancy.service_unit
-					else:
-						service_unit_names = inpatient_occupancy.service_unit
+				if inpatient_occupancy.service_unit in billable_service_units:
+					service_unit_names.append(inpatient_occupancy.service_unit)
 		if service_unit_names:
-			pending_invoices["Inpatient Occupancy"] = service_unit_names
+			pending_invoices["Inpatient Occupancy"] = ", ".join(service_unit_names)
 
 	docs = ["Patient Appointment", "Patient Encounter", "Lab Test", "Clinical Procedure"]
 
@@ -292,15 +299,9 @@ def get_pending_invoices(inpatient_record):
 
 def get_pending_doc(doc, doc_name_list, pending_invoices):
 	if doc_name_list:
-		doc_ids = False
-		for doc_name in doc_name_list:
-			doc_link = get_link_to_form(doc, doc_name.name)
-			if doc_ids:
-				doc_ids += ", " + doc_link
-			else:
-				doc_ids = doc_link
-		if doc_ids:
-			pending_invoices[doc] = doc_ids
+		pending_invoices[doc] = ", ".join(
+			get_link_to_form(doc, doc_name.name) for doc_name in doc_name_list
+		)
 
 	return pending_invoices
 
@@ -378,13 +379,13 @@ def transfer_patient(inpatient_record, service_unit, check_in):
 
 def patient_leave_service_unit(inpatient_record, check_out, leave_from):
 	if inpatient_record.inpatient_occupancies:
+		vacated_service_units = []
 		for inpatient_occupancy in inpatient_record.inpatient_occupancies:
 			if inpatient_occupancy.left != 1 and inpatient_occupancy.service_unit == leave_from:
 				inpatient_occupancy.left = True
 				inpatient_occupancy.check_out = check_out
-				frappe.db.set_value(
-					"Healthcare Service Unit", inpatient_occupancy.service_unit, "occupancy_status", "Vacant"
-				)
+				vacated_service_units.append(inpatient_occupancy.service_unit)
+		set_service_units_vacant(vacated_service_units)
 	inpatient_record.save(ignore_permissions=True)
 
 
@@ -393,30 +394,38 @@ def patient_leave_service_unit(inpatient_record, check_out, leave_from):
 def get_leave_from(doctype, txt, searchfield, start, page_len, filters):
 	docname = filters["docname"]
 
-	query = """select io.service_unit
-		from `tabInpatient Occupancy` io, `tabInpatient Record` ir
-		where io.parent = '{docname}' and io.parentfield = 'inpatient_occupancies'
-		and io.left!=1 and io.parent = ir.name"""
-
-	return frappe.db.sql(
-		query.format(
-			**{"docname": docname, "searchfield": searchfield, "mcond": get_match_cond(doctype)}
-		),
-		{"txt": "%%%s%%" % txt, "_txt": txt.replace("%", ""), "start": start, "page_len": page_len},
-	)
+	inpatient_occupancy = frappe.qb.DocType("Inpatient Occupancy")
+	return (
+		frappe.qb.from_(inpatient_occupancy)
+		.select(inpatient_occupancy.service_unit)
+		.distinct()
+		.where(inpatient_occupancy.parent == docname)
+		.where(inpatient_occupancy.parentfield == "inpatient_occupancies")
+		.where(inpatient_occupancy.left != 1)
+		.where(inpatient_occupancy.service_unit.like(f"%{txt}%"))
+		.offset(start)
+		.limit(page_len)
+	).run()
 
 
 def is_service_unit_billable(service_unit):
+	return service_unit in get_billable_service_units({service_unit})
+
+
+def get_billable_service_units(service_units):
+	if not service_units:
+		return set()
+
 	service_unit_doc = frappe.qb.DocType("Healthcare Service Unit")
 	service_unit_type = frappe.qb.DocType("Healthcare Service Unit Type")
 	result = (
 		frappe.qb.from_(service_unit_doc)
 		.left_join(service_unit_type)
 		.on(service_unit_doc.service_unit_type == service_unit_type.name)
-		.select(service_unit_type.is_billable)
-		.where(service_unit_doc.name == service_unit)
+		.select(service_unit_doc.name, service_unit_type.is_billable)
+		.where(service_unit_doc.name.isin(list(service_units)))
 	).run(as_dict=1)
-	return result[0].get("is_billable", 0)
+	return {row.name for row in result if row.is_billable}
 
 
 @frappe.whitelist()
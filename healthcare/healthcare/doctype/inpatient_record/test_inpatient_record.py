@@ -5,7 +5,7 @@
 
 import frappe
 from frappe.tests.utils import FrappeTestCase
-from frappe.utils import now_datetime, today
+from frappe.utils import add_to_date, now_datetime, today
 from frappe.utils.make_random import get_random
 
 from healthcare.healthcare.doctype.inpatient_record.inpatient_record import (
@@ -14,7 +14,10 @@ from healthcare.healthcare.doctype.inpatient_record.inpatient_record import (
 	schedule_discharge,
 )
 from healthcare.healthcare.doctype.lab_test.test_lab_test import create_patient_encounter
-from healthcare.healthcare.utils import get_encounters_to_invoice
+from healthcare.healthcare.utils import (
+	get_encounters_to_invoice,
+	get_inpatient_services_to_invoice,
+)
 
 
 class TestInpatientRecord(FrappeTestCase):
@@ -127,6 +130,59 @@ class TestInpatientRecord(FrappeTestCase):
 		self.assertRaises(frappe.ValidationError, ip_record_new.save)
 		frappe.db.sql("""delete from `tabInpatient Record`""")
 
+	def test_inpatient_occupancy_qty_to_invoice(self):
+		frappe.db.sql("""delete from `tabInpatient Record`""")
+		patient = create_patient()
+		ip_record = create_inpatient(patient)
+		ip_record.expected_length_of_stay = 0
+		ip_record.save(ignore_permissions=True)
+
+		service_unit = get_healthcare_service_unit()
+		service_unit_type = frappe.db.get_value(
+			"Healthcare Service Unit", service_unit, "service_unit_type"
+		)
+		billing = frappe.db.get_value(
+			"Healthcare Service Unit Type",
+			service_unit_type,
+			["is_billable", "no_of_hours"],
+			as_dict=True,
+		)
+		self.addCleanup(
+			frappe.db.set_value, "Healthcare Service Unit Type", service_unit_type, billing
+		)
+		frappe.db.set_value(
+			"Healthcare Service Unit Type", service_unit_type, {"is_billable": 1, "no_of_hours": 1}
+		)
+
+		admit_patient(ip_record, service_unit, now_datetime())
+		self.addCleanup(discharge_inpatient, ip_record.name)
+		schedule_discharge(frappe.as_json({"patient": patient}))
+		ip_record = frappe.get_doc("Inpatient Record", ip_record.name)
+		occupancy = ip_record.inpatient_occupancies[0]
+
+		# hours occupied, billed in half units rounded up with a minimum of half a unit
+		for hours, qty in ((2, 2), (1.5, 1.5), (1.3, 1.5), (1.7, 2), (0.2, 0.5)):
+			frappe.db.set_value(
+				"Inpatient Occupancy",
+				occupancy.name,
+				"check_out",
+				add_to_date(occupancy.check_in, hours=hours),
+			)
+			services = get_inpatient_services_to_invoice(patient, "_Test Company")
+			service = next(
+				service for service in services if service["reference_name"] == occupancy.name
+			)
+			self.assertEqual(service["qty"], qty)
+
+
+def discharge_inpatient(inpatient_record):
+	ip_record = frappe.get_doc("Inpatient Record", inpatient_record)
+	if ip_record.status == "Admitted":
+		schedule_discharge(frappe.as_json({"patient": ip_record.patient}))
+		ip_record.reload()
+	mark_invoiced_inpatient_occupancy(ip_record)
+	discharge_patient(ip_record)
+
 
 def mark_invoiced_inpatient_occupancy(ip_record):
 	if ip_record.inpatient_occupancies:
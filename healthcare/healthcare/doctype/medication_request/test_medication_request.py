@@ -14,6 +14,7 @@ from healthcare.healthcare.doctype.service_request.test_service_request import (
 	create_encounter,
 	create_sales_invoice,
 )
+from healthcare.healthcare.utils import get_drugs_to_invoice
 
 
 class TestMedicationRequest(unittest.TestCase):
@@ -40,6 +41,24 @@ class TestMedicationRequest(unittest.TestCase):
 				"Invoiced",
 			)
 
+	def test_get_drugs_to_invoice(self):
+		patient, practitioner = create_healthcare_docs()
+		medication = create_medication()
+		drug_code = medication.linked_items[0].item
+		frappe.db.set_value("Item", drug_code, "disabled", 0)
+		encounter = create_encounter(patient, practitioner, "drug_prescription", medication, submit=True)
+		medication_request = frappe.get_doc("Medication Request", {"order_group": encounter.name})
+		medication_request.submit()
+
+		drugs = get_drugs_to_invoice(encounter.name)
+		self.assertIn(drug_code, [drug["drug_code"] for drug in drugs])
+
+		# linked item marked not billable
+		frappe.db.set_value("Item", drug_code, "disabled", 1)
+		drugs = get_drugs_to_invoice(encounter.name)
+		self.assertNotIn(drug_code, [drug["drug_code"] for drug in drugs])
+		frappe.db.set_value("Item", drug_code, "disabled", 0)
+
 
 def create_medication():
 	if not frappe.db.exists("Medication", "_Test Medication"):
@@ -67,9 +86,15 @@ def create_medication():
 					"dosage_form": "Capsule",
 					"default_prescription_dosage": "0-1-0",
 					"default_prescription_duration": "1 Hour",
-					"is_billable": 1,
 					"rate": 800,
-					"linked_items": [{"item": item.item_code, "item_code": item.item_name, "item_group": "Drug"}],
+					"linked_items": [
+						{
+							"item": item.item_code,
+							"item_code": item.item_name,
+							"item_group": "Drug",
+							"is_billable": 1,
+						}
+					],
 				}
 			).insert(ignore_permissions=True, ignore_mandatory=True)
 			return medication
@@ -40,10 +40,11 @@ class Observation(Document):
 			frappe.db.set_value("Service Request", self.service_request, "status", "active-Request Status")
 
 	def set_age(self):
-		patient_doc = frappe.get_doc("Patient", self.patient)
+		patient_doc = frappe.get_cached_doc("Patient", self.patient)
 		if patient_doc.dob:
-			self.age = patient_doc.calculate_age().get("age_in_string")
-			self.days = patient_doc.calculate_age().get("age_in_days")
+			age = patient_doc.calculate_age()
+			self.age = age.get("age_in_string")
+			self.days = age.get("age_in_days")
 
 	def set_status(self):
 		if self.status not in ["Approved", "Disapproved"]:
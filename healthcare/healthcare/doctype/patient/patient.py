@@ -159,18 +159,10 @@ class Patient(Document):
 
 	@property
 	def age(self):
-		if not self.dob:
-			return
-		dob = getdate(self.dob)
-		age = dateutil.relativedelta.relativedelta(getdate(), dob)
-		return age
+		return get_age_from_dob(self.dob)
 
 	def get_age(self):
-		age = self.age
-		if not age:
-			return
-		age_str = f'{str(age.years)} {_("Year(s)")} {str(age.months)} {_("Month(s)")} {str(age.days)} {_("Day(s)")}'
-		return age_str
+		return format_age(self.dob)
 
 	@frappe.whitelist()
 	def invoice_patient_registration(self):
@@ -293,6 +285,21 @@ class Patient(Document):
 		self.notify_update()
 
 
+def get_age_from_dob(dob):
+	"""returns age as of today from dob as a relativedelta"""
+	if not dob:
+		return
+	return dateutil.relativedelta.relativedelta(getdate(), getdate(dob))
+
+
+def format_age(dob):
+	"""returns age as of today from dob in years, months and days, None if born today"""
+	age = get_age_from_dob(dob)
+	if not age:
+		return
+	return f'{str(age.years)} {_("Year(s)")} {str(age.months)} {_("Month(s)")} {str(age.days)} {_("Day(s)")}'
+
+
 def create_customer(doc):
 	customer = frappe.get_doc(
 		{
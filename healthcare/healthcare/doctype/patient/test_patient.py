@@ -7,7 +7,9 @@ import os
 
 import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import getdate
 
+from healthcare.healthcare.doctype.patient.patient import format_age
 from healthcare.healthcare.doctype.patient_appointment.test_patient_appointment import (
 	create_patient,
 )
@@ -131,3 +133,16 @@ class TestPatient(FrappeTestCase):
 
 		self.assertEqual(p1_customer_name, p2_customer_name)
 		self.assertEqual(p2_customer.customer_name, "John Doe")
+
+	def test_format_age(self):
+		self.assertIsNone(format_age(None))
+		# born today, no age like Patient.get_age has always returned
+		self.assertIsNone(format_age(getdate()))
+
+		today = getdate()
+		dob = today.replace(year=today.year - 2, day=1)
+		self.assertEqual(format_age(dob), f"2 Year(s) 0 Month(s) {today.day - 1} Day(s)")
+
+		patient = frappe.new_doc("Patient")
+		patient.dob = dob
+		self.assertEqual(patient.get_age(), format_age(dob))
@@ -330,15 +330,35 @@ class PatientEncounter(Document):
 		filters = {"patient": self.patient, "docstatus": 1}
 		medication_requests = frappe.get_all("Medication Request", filters, ["*"])
 		service_requests = frappe.get_all("Service Request", filters, ["*"])
-		for service_request in service_requests:
-			if service_request.template_dt == "Lab Test Template":
-				lab_test = frappe.db.get_value("Lab Test", {"service_request": service_request.name}, "name")
-				if lab_test:
-					subject = frappe.db.get_value(
-						"Patient Medical Record", {"reference_name": lab_test}, "subject"
-					)
-					if subject:
-						service_request["lab_details"] = subject
+
+		lab_service_requests = [
+			service_request.name
+			for service_request in service_requests
+			if service_request.template_dt == "Lab Test Template"
+		]
+		if lab_service_requests:
+			# rows come newest first, keep the first per key like get_value did
+			lab_tests = {}
+			for lab_service_request, lab_test in frappe.get_all(
+				"Lab Test",
+				filters={"service_request": ["in", lab_service_requests]},
+				fields=["service_request", "name"],
+				as_list=True,
+			):
+				lab_tests.setdefault(lab_service_request, lab_test)
+			subjects = {}
+			if lab_tests:
+				for reference_name, subject in frappe.get_all(
+					"Patient Medical Record",
+					filters={"reference_name": ["in", list(lab_tests.values())]},
+					fields=["reference_name", "subject"],
+					as_list=True,
+				):
+					subjects.setdefault(reference_name, subject)
+			for service_request in service_requests:
+				subject = subjects.get(lab_tests.get(service_request.name))
+				if subject:
+					service_request["lab_details"] = subject
 		clinical_notes = frappe.get_all(
 			"Clinical Note",
 			{
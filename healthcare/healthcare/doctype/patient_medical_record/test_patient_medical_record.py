@@ -14,7 +14,9 @@ from healthcare.healthcare.doctype.patient_appointment.test_patient_appointment
 	create_encounter,
 	create_healthcare_docs,
 	create_medical_department,
+	create_patient,
 )
+from healthcare.healthcare.utils import render_docs_as_html
 
 
 class TestPatientMedicalRecord(FrappeTestCase):
@@ -62,6 +64,16 @@ class TestPatientMedicalRecord(FrappeTestCase):
 		)
 		self.assertTrue(medical_rec)
 
+	def test_render_docs_as_html(self):
+		patients = [create_patient(0), create_patient(1)]
+		docs = [{"doctype": "Patient", "docname": patient} for patient in patients]
+
+		# whitelisted calls pass docs as a json string
+		for docs_arg in (docs, frappe.as_json(docs)):
+			html = render_docs_as_html(docs_arg)["html"]
+			for patient in patients:
+				self.assertIn(frappe.db.get_value("Patient", patient, "first_name"), html)
+
 
 def create_procedure(appointment):
 	if appointment:
@@ -6,6 +6,7 @@
 import base64
 import json
 import math
+from collections import defaultdict
 
 import frappe
 from frappe import _
@@ -15,19 +16,22 @@ from frappe.utils.formatters import format_value
 from erpnext.setup.utils import insert_record
 
 from healthcare.healthcare.doctype.healthcare_settings.healthcare_settings import (
-	get_income_account,
+	get_income_accounts,
 )
 from healthcare.healthcare.doctype.lab_test.lab_test import create_multiple
 from healthcare.healthcare.doctype.observation.observation import add_observation
 from healthcare.healthcare.doctype.observation_template.observation_template import (
 	get_observation_template_details,
 )
+from healthcare.healthcare.doctype.patient.patient import format_age
 from healthcare.setup import setup_healthcare
 
 
 @frappe.whitelist()
 def get_healthcare_services_to_invoice(patient, company):
-	patient = frappe.get_doc("Patient", patient)
+	if not frappe.db.exists("Patient", patient):
+		frappe.throw(_("Patient {0} not found").format(frappe.bold(patient)))
+
 	items_to_invoice = []
 	if patient:
 		validate_customer_created(patient)
@@ -45,9 +49,9 @@ def get_healthcare_services_to_invoice(patient, company):
 
 
 def validate_customer_created(patient):
-	if not frappe.db.get_value("Patient", patient.name, "customer"):
+	if not frappe.get_cached_value("Patient", patient, "customer"):
 		msg = _("Please set a Customer linked to the Patient")
-		msg += " <b><a href='/app/Form/Patient/{0}'>{0}</a></b>".format(patient.name)
+		msg += " <b><a href='/app/Form/Patient/{0}'>{0}</a></b>".format(patient)
 		frappe.throw(msg, title=_("Customer Not Found"))
 
 
@@ -55,15 +59,29 @@ def get_appointments_to_invoice(patient, company):
 	appointments_to_invoice = []
 	patient_appointments = frappe.get_list(
 		"Patient Appointment",
-		fields="*",
+		fields=[
+			"name",
+			"procedure_template",
+			"practitioner",
+			"department",
+			"service_unit",
+			"appointment_type",
+			"inpatient_record",
+		],
 		filters={
-			"patient": patient.name,
+			"patient": patient,
 			"company": company,
 			"invoiced": 0,
 			"status": ["!=", "Cancelled"],
 		},
 		order_by="appointment_date",
 	)
+	enable_free_follow_ups = frappe.db.get_single_value(
+		"Healthcare Settings", "enable_free_follow_ups"
+	)
+	income_accounts = get_income_accounts(
+		[appointment.practitioner for appointment in patient_appointments], company
+	)
 
 	for appointment in patient_appointments:
 		# Procedure Appointments
@@ -80,9 +98,9 @@ def get_appointments_to_invoice(patient, company):
 				)
 		# Consultation Appointments, should check fee validity
 		else:
-			if frappe.db.get_single_value(
-				"Healthcare Settings", "enable_free_follow_ups"
-			) and frappe.db.exists("Fee Validity Reference", {"appointment": appointment.name}):
+			if enable_free_follow_ups and frappe.db.exists(
+				"Fee Validity Reference", {"appointment": appointment.name}
+			):
 				continue  # Skip invoicing, fee validty present
 			practitioner_charge = 0
 			income_account = None
@@ -91,7 +109,7 @@ def get_appointments_to_invoice(patient, company):
 				details = get_appointment_billing_item_and_rate(appointment)
 				service_item = details.get("service_item")
 				practitioner_charge = details.get("practitioner_charge")
-				income_account = get_income_account(appointment.practitioner, appointment.company)
+				income_account = income_accounts.get(appointment.practitioner)
 			appointments_to_invoice.append(
 				{
 					"reference_type": "Patient Appointment",
@@ -115,21 +133,25 @@ def get_encounters_to_invoice(patient, company):
 		filters={"patient": patient, "company": company, "invoiced": False, "docstatus": 1},
 	)
 	if encounters:
+		do_not_bill_inpatient_encounters = frappe.db.get_single_value(
+			"Healthcare Settings", "do_not_bill_inpatient_encounters"
+		)
+		income_accounts = get_income_accounts(
+			[encounter.practitioner for encounter in encounters], company
+		)
 		for encounter in encounters:
 			if not encounter.appointment:
 				practitioner_charge = 0
 				income_account = None
 				service_item = None
 				if encounter.practitioner:
-					if encounter.inpatient_record and frappe.db.get_single_value(
-						"Healthcare Settings", "do_not_bill_inpatient_encounters"
-					):
+					if encounter.inpatient_record and do_not_bill_inpatient_encounters:
 						continue
 
 					details = get_appointment_billing_item_and_rate(encounter)
 					service_item = details.get("service_item")
 					practitioner_charge = details.get("practitioner_charge")
-					income_account = get_income_account(encounter.practitioner, encounter.company)
+					income_account = income_accounts.get(encounter.practitioner)
 
 				encounters_to_invoice.append(
 					{
@@ -150,20 +172,21 @@ def get_lab_tests_to_invoice(patient, company):
 		"Lab Test",
 		fields=["name", "template"],
 		filters={
-			"patient": patient.name,
+			"patient": patient,
 			"company": company,
 			"invoiced": False,
 			"docstatus": 1,
 			"service_request": "",
 		},
 	)
+	templates = get_records_by_name(
+		"Lab Test Template", [lab_test.template for lab_test in lab_tests], ["item", "is_billable"]
+	)
 	for lab_test in lab_tests:
-		item, is_billable = frappe.get_cached_value(
-			"Lab Test Template", lab_test.template, ["item", "is_billable"]
-		)
-		if is_billable:
+		template = templates.get(lab_test.template)
+		if template and template.is_billable:
 			lab_tests_to_invoice.append(
-				{"reference_type": "Lab Test", "reference_name": lab_test.name, "service": item}
+				{"reference_type": "Lab Test", "reference_name": lab_test.name, "service": template.item}
 			)
 
 	return lab_tests_to_invoice
@@ -175,7 +198,7 @@ def get_observations_to_invoice(patient, company):
 		"Observation",
 		fields=["name", "observation_template"],
 		filters={
-			"patient": patient.name,
+			"patient": patient,
 			"company": company,
 			"invoiced": False,
 			"docstatus": 1,
@@ -198,23 +221,43 @@ def get_clinical_procedures_to_invoice(patient, company):
 	clinical_procedures_to_invoice = []
 	procedures = frappe.get_list(
 		"Clinical Procedure",
-		fields="*",
+		fields=[
+			"name",
+			"appointment",
+			"procedure_template",
+			"invoice_separately_as_consumables",
+			"consume_stock",
+			"status",
+			"consumption_invoiced",
+			"consumable_total_amount",
+			"consumption_details",
+		],
 		filters={
-			"patient": patient.name,
+			"patient": patient,
 			"company": company,
 			"invoiced": False,
 			"docstatus": 1,
 			"service_request": "",
 		},
 	)
+	templates = get_records_by_name(
+		"Clinical Procedure Template",
+		[procedure.procedure_template for procedure in procedures if not procedure.appointment],
+		["item", "is_billable"],
+	)
+	consumable_item = frappe.db.get_single_value(
+		"Healthcare Settings", "clinical_procedure_consumable_item"
+	)
 	for procedure in procedures:
 		if not procedure.appointment:
-			item, is_billable = frappe.get_cached_value(
-				"Clinical Procedure Template", procedure.procedure_template, ["item", "is_billable"]
-			)
-			if procedure.procedure_template and is_billable:
+			template = templates.get(procedure.procedure_template)
+			if template and template.is_billable:
 				clinical_procedures_to_invoice.append(
-					{"reference_type": "Clinical Procedure", "reference_name": procedure.name, "service": item}
+					{
+						"reference_type": "Clinical Procedure",
+						"reference_name": procedure.name,
+						"service": template.item,
+					}
 				)
 
 		# consumables
@@ -224,10 +267,7 @@ def get_clinical_procedures_to_invoice(patient, company):
 			and procedure.status == "Completed"
 			and not procedure.consumption_invoiced
 		):
-			service_item = frappe.db.get_single_value(
-				"Healthcare Settings", "clinical_procedure_consumable_item"
-			)
-			if not service_item:
+			if not consumable_item:
 				msg = _("Please Configure Clinical Procedure Consumable Item in {0}").format(
 					get_link_to_form("Healthcare Settings", "Healthcare Settings")
 				)
@@ -238,7 +278,7 @@ def get_clinical_procedures_to_invoice(patient, company):
 				{
 					"reference_type": "Clinical Procedure",
 					"reference_name": procedure.name,
-					"service": service_item,
+					"service": consumable_item,
 					"rate": procedure.consumable_total_amount,
 					"description": procedure.consumption_details,
 				}
@@ -252,45 +292,37 @@ def get_inpatient_services_to_invoice(patient, company):
 	inpatient_services = frappe.db.sql(
 		"""
 			SELECT
-				io.*
+				io.*, hsut.is_billable, hsut.no_of_hours, hsut.item
 			FROM
-				`tabInpatient Record` ip, `tabInpatient Occupancy` io
+				`tabInpatient Record` ip
+				JOIN `tabInpatient Occupancy` io ON io.parent=ip.name
+				LEFT JOIN `tabHealthcare Service Unit` hsu ON hsu.name=io.service_unit
+				LEFT JOIN `tabHealthcare Service Unit Type` hsut ON hsut.name=hsu.service_unit_type
 			WHERE
 				ip.patient=%s
 				and ip.company=%s
-				and io.parent=ip.name
 				and io.left=1
 				and io.invoiced=0
 		""",
-		(patient.name, company),
+		(patient, company),
 		as_dict=1,
 	)
 
 	for inpatient_occupancy in inpatient_services:
-		service_unit_type = frappe.db.get_value(
-			"Healthcare Service Unit", inpatient_occupancy.service_unit, "service_unit_type"
-		)
-		service_unit_type = frappe.get_cached_doc("Healthcare Service Unit Type", service_unit_type)
-		if service_unit_type and service_unit_type.is_billable:
+		if inpatient_occupancy.is_billable:
 			hours_occupied = flt(
 				time_diff_in_hours(inpatient_occupancy.check_out, inpatient_occupancy.check_in), 2
 			)
 			qty = 0.5
 			if hours_occupied > 0:
-				actual_qty = hours_occupied / service_unit_type.no_of_hours
-				floor = math.floor(actual_qty)
-				decimal_part = actual_qty - floor
-				if decimal_part > 0.5:
-					qty = rounded(floor + 1, 1)
-				elif decimal_part < 0.5 and decimal_part > 0:
-					qty = rounded(floor + 0.5, 1)
-				if qty <= 0:
-					qty = 0.5
+				actual_qty = hours_occupied / inpatient_occupancy.no_of_hours
+				# bill in half units, rounding up, with a minimum of half a unit
+				qty = max(0.5, rounded(math.ceil(actual_qty * 2) / 2, 1))
 			services_to_invoice.append(
 				{
 					"reference_type": "Inpatient Occupancy",
 					"reference_name": inpatient_occupancy.name,
-					"service": service_unit_type.item,
+					"service": inpatient_occupancy.item,
 					"qty": qty,
 				}
 			)
@@ -304,7 +336,7 @@ def get_therapy_plans_to_invoice(patient, company):
 		"Therapy Plan",
 		fields=["therapy_plan_template", "name"],
 		filters={
-			"patient": patient.name,
+			"patient": patient,
 			"invoiced": 0,
 			"company": company,
 			"therapy_plan_template": ("!=", ""),
@@ -327,16 +359,17 @@ def get_therapy_plans_to_invoice(patient, company):
 
 def get_therapy_sessions_to_invoice(patient, company):
 	therapy_sessions_to_invoice = []
-	therapy_plans = frappe.db.get_all("Therapy Plan", {"therapy_plan_template": ("!=", "")})
-	therapy_plans_created_from_template = []
-	for entry in therapy_plans:
-		therapy_plans_created_from_template.append(entry.name)
+	therapy_plans_created_from_template = frappe.db.get_all(
+		"Therapy Plan",
+		{"patient": patient, "therapy_plan_template": ("!=", "")},
+		pluck="name",
+	)
 
 	therapy_sessions = frappe.get_list(
 		"Therapy Session",
-		fields="*",
+		fields=["name", "appointment", "therapy_type"],
 		filters={
-			"patient": patient.name,
+			"patient": patient,
 			"invoiced": 0,
 			"company": company,
 			"therapy_plan": ("not in", therapy_plans_created_from_template),
@@ -344,16 +377,20 @@ def get_therapy_sessions_to_invoice(patient, company):
 			"service_request": "",
 		},
 	)
+	therapy_types = get_records_by_name(
+		"Therapy Type",
+		[therapy.therapy_type for therapy in therapy_sessions if not therapy.appointment],
+		["is_billable", "item"],
+	)
 	for therapy in therapy_sessions:
 		if not therapy.appointment:
-			if therapy.therapy_type and frappe.db.get_value(
-				"Therapy Type", therapy.therapy_type, "is_billable"
-			):
+			therapy_type = therapy_types.get(therapy.therapy_type)
+			if therapy_type and therapy_type.is_billable:
 				therapy_sessions_to_invoice.append(
 					{
 						"reference_type": "Therapy Session",
 						"reference_name": therapy.name,
-						"service": frappe.db.get_value("Therapy Type", therapy.therapy_type, "item"),
+						"service": therapy_type.item,
 					}
 				)
 
@@ -364,29 +401,25 @@ def get_service_requests_to_invoice(patient, company):
 	orders_to_invoice = []
 	service_requests = frappe.get_list(
 		"Service Request",
-		fields=["*"],
+		fields=["name", "template_dt", "template_dn", "quantity"],
 		filters={
-			"patient": patient.name,
+			"patient": patient,
 			"company": company,
 			"billing_status": ["!=", "Invoiced"],
 			"docstatus": 1,
 		},
 	)
+	template_dns = {}
 	for service_request in service_requests:
-		item, is_billable = frappe.get_cached_value(
-			service_request.template_dt, service_request.template_dn, ["item", "is_billable"]
-		)
-		price_list, price_list_currency = frappe.db.get_values(
-			"Price List", {"selling": 1}, ["name", "currency"]
-		)[0]
-		args = {
-			"doctype": "Sales Invoice",
-			"item_code": item,
-			"company": service_request.get("company"),
-			"customer": frappe.db.get_value("Patient", service_request.get("patient"), "customer"),
-			"plc_conversion_rate": 1.0,
-			"conversion_rate": 1.0,
-		}
+		template_dns.setdefault(service_request.template_dt, []).append(service_request.template_dn)
+	templates = {
+		template_dt: get_records_by_name(template_dt, dns, ["item", "is_billable"])
+		for template_dt, dns in template_dns.items()
+	}
+
+	for service_request in service_requests:
+		template = templates[service_request.template_dt].get(service_request.template_dn)
+		item, is_billable = (template.item, template.is_billable) if template else (None, None)
 		if is_billable:
 			orders_to_invoice.append(
 				{
@@ -399,6 +432,18 @@ def get_service_requests_to_invoice(patient, company):
 	return orders_to_invoice
 
 
+def get_records_by_name(doctype, names, fields):
+	"""returns {name: row} with the requested fields, fetched in a single query"""
+	names = list({name for name in names if name})
+	if not names:
+		return {}
+
+	return {
+		row.name: row
+		for row in frappe.get_all(doctype, filters={"name": ["in", names]}, fields=["name", *fields])
+	}
+
+
 @frappe.whitelist()
 def get_appointment_billing_item_and_rate(doc):
 	if isinstance(doc, str):
@@ -521,10 +566,12 @@ def get_healthcare_service_item(is_inpatient):
 
 
 def manage_invoice_validate(doc, method):
-	if doc.service_unit and len(doc.items):
-		for item in doc.items:
-			if not item.service_unit:
-				item.service_unit = doc.service_unit
+	service_unit = doc.service_unit
+	if not service_unit:
+		return
+
+	for item in doc.items:
+		item.service_unit = item.service_unit or service_unit
 
 
 def manage_invoice_submit_cancel(doc, method):
@@ -532,11 +579,13 @@ def manage_invoice_submit_cancel(doc, method):
 		return
 
 	if doc.items:
+		invoiced_docs = {}
 		for item in doc.items:
 			if item.get("reference_dt") and item.get("reference_dn"):
 				# TODO check
 				# if frappe.get_meta(item.reference_dt).has_field("invoiced"):
-				set_invoiced(item, method, doc.name)
+				set_invoiced(item, method, invoiced_docs, doc.name)
+		update_invoiced_docs(invoiced_docs, method == "on_submit")
 		if method == "on_submit" and frappe.db.get_single_value(
 			"Healthcare Settings", "create_observation_on_si_submit"
 		):
@@ -575,23 +624,35 @@ def manage_invoice_submit_cancel(doc, method):
 					)
 
 
-def set_invoiced(item, method, ref_invoice=None):
+def set_invoiced(item, method, invoiced_docs, ref_invoice=None):
+	"""
+	Set invoiced flag on the referenced document. The flag update is collected into
+	invoiced_docs, keyed by (doctype, fieldname), to be written in bulk by update_invoiced_docs
+	"""
 	invoiced = False
 	if method == "on_submit":
 		validate_invoiced_on_submit(item)
 		invoiced = True
 
+	invoiced_field = None
 	if item.reference_dt == "Clinical Procedure":
 		service_item = frappe.db.get_single_value(
 			"Healthcare Settings", "clinical_procedure_consumable_item"
 		)
 		if service_item == item.item_code:
-			frappe.db.set_value(item.reference_dt, item.reference_dn, "consumption_invoiced", invoiced)
+			invoiced_field = "consumption_invoiced"
 		else:
-			frappe.db.set_value(item.reference_dt, item.reference_dn, "invoiced", invoiced)
+			invoiced_field = "invoiced"
 	else:
 		if item.reference_dt not in ["Service Request", "Medication Request"]:
-			frappe.db.set_value(item.reference_dt, item.reference_dn, "invoiced", invoiced)
+			invoiced_field = "invoiced"
+
+	if invoiced_field:
+		docnames = invoiced_docs.setdefault((item.reference_dt, invoiced_field), set())
+		# flag is written after all items are processed, catch duplicate references here
+		if invoiced and item.reference_dn in docnames:
+			throw_already_invoiced(item)
+		docnames.add(item.reference_dn)
 
 	if item.reference_dt == "Patient Appointment":
 		if frappe.db.get_value("Patient Appointment", item.reference_dn, "procedure_template"):
@@ -642,11 +703,20 @@ def validate_invoiced_on_submit(item):
 	else:
 		is_invoiced = frappe.db.get_value(item.reference_dt, item.reference_dn, "invoiced")
 	if is_invoiced:
-		frappe.throw(
-			_("The item referenced by {0} - {1} is already invoiced").format(
-				item.reference_dt, item.reference_dn
-			)
+		throw_already_invoiced(item)
+
+
+def throw_already_invoiced(item):
+	frappe.throw(
+		_("The item referenced by {0} - {1} is already invoiced").format(
+			item.reference_dt, item.reference_dn
 		)
+	)
+
+
+def update_invoiced_docs(invoiced_docs, invoiced):
+	for (doctype, fieldname), docnames in invoiced_docs.items():
+		frappe.db.set_value(doctype, {"name": ["in", list(docnames)]}, fieldname, invoiced)
 
 
 def manage_prescriptions(invoiced, ref_dt, ref_dn, dt, created_check_field):
@@ -669,7 +739,7 @@ def manage_doc_for_appointment(dt_from_appointment, appointment, invoiced):
 def get_drugs_to_invoice(encounter):
 	encounter = frappe.get_doc("Patient Encounter", encounter)
 	if encounter:
-		patient = frappe.get_doc("Patient", encounter.patient)
+		patient = frappe.db.get_value("Patient", encounter.patient, ["name", "customer"], as_dict=1)
 		if patient:
 			if patient.customer:
 				orders_to_invoice = []
@@ -683,15 +753,23 @@ def get_drugs_to_invoice(encounter):
 						"docstatus": 1,
 					},
 				)
-				for medication_request in medication_requests:
-					if medication_request.medication:
-						is_billable = frappe.get_cached_value(
-							"Medication", medication_request.medication, ["is_billable"]
-						)
-					else:
-						is_billable = frappe.db.exists(
-							"Item", {"name": medication_request.medication_item, "disabled": False}
+				# a Medication Linked Item's is_billable is kept on its Item as disabled
+				medication_items = [
+					medication_request.medication_item
+					for medication_request in medication_requests
+					if medication_request.medication_item
+				]
+				billable_items = set()
+				if medication_items:
+					billable_items = set(
+						frappe.get_all(
+							"Item",
+							filters={"name": ["in", medication_items], "disabled": 0},
+							pluck="name",
 						)
+					)
+				for medication_request in medication_requests:
+					is_billable = medication_request.medication_item in billable_items
 
 					description = ""
 					if medication_request.dosage and medication_request.period:
@@ -743,24 +821,37 @@ def get_children(doctype, parent=None, company=None, is_root=False):
 		fields += [parent_fieldname + " as parent"]
 
 	service_units = frappe.get_list(doctype, fields=fields, filters=filters)
-	for each in service_units:
-		if each["expandable"] != 1 or each["value"].startswith("All Healthcare Service Units"):
-			continue
+	group_nodes = [
+		each
+		for each in service_units
+		if each["expandable"] == 1 and not each["value"].startswith("All Healthcare Service Units")
+	]
+	if not group_nodes:
+		return service_units
 
-		available_count = frappe.db.count(
-			"Healthcare Service Unit",
-			filters={"parent_healthcare_service_unit": each["value"], "inpatient_occupancy": 1},
-		)
+	occupancy = frappe.db.sql(
+		"""
+			SELECT
+				parent_healthcare_service_unit,
+				COUNT(*) AS available_count,
+				SUM(occupancy_status = 'Occupied') AS occupied_count
+			FROM
+				`tabHealthcare Service Unit`
+			WHERE
+				inpatient_occupancy = 1
+				AND parent_healthcare_service_unit IN %(parents)s
+			GROUP BY
+				parent_healthcare_service_unit
+		""",
+		{"parents": tuple(each["value"] for each in group_nodes)},
+		as_dict=1,
+	)
+	occupancy = {row.parent_healthcare_service_unit: row for row in occupancy}
 
-		if available_count > 0:
-			occupied_count = frappe.db.count(
-				"Healthcare Service Unit",
-				filters={
-					"parent_healthcare_service_unit": each["value"],
-					"inpatient_occupancy": 1,
-					"occupancy_status": "Occupied",
-				},
-			)
+	for each in group_nodes:
+		counts = occupancy.get(each["value"])
+		if counts and counts.available_count > 0:
+			occupied_count, available_count = int(counts.occupied_count), counts.available_count
 			# set occupancy status of group node
 			each["occupied_of_available"] = f"{str(occupied_count)} Occupied of {str(available_count)}"
 
@@ -787,10 +878,14 @@ def get_patient_vitals(patient, from_date=None, to_date=None):
 @frappe.whitelist()
 def render_docs_as_html(docs):
 	# docs key value pair {doctype: docname}
-	docs_html = "<div class='col-md-12 col-sm-12 text-muted'>"
+	if isinstance(docs, str):
+		docs = json.loads(docs)
+
+	docs_html = ["<div class='col-md-12 col-sm-12 text-muted'>"]
 	for doc in docs:
-		docs_html += render_doc_as_html(doc["doctype"], doc["docname"])["html"] + "<br/>"
-		return {"html": docs_html}
+		docs_html.append(render_doc_as_html(doc["doctype"], doc["docname"])["html"] + "<br/>")
+	docs_html.append("</div>")
+	return {"html": "".join(docs_html)}
 
 
 @frappe.whitelist()
@@ -801,18 +896,23 @@ def render_doc_as_html(doctype, docname, exclude_fields=None):
 	exclude_fields = exclude_fields or []
 	doc = frappe.get_doc(doctype, docname)
 	meta = frappe.get_meta(doctype)
-	doc_html = section_html = section_label = html = ""
+	# html fragments are collected in lists and joined once they are flushed
+	doc_html, section_html, html = [], [], []
+	section_label = ""
 	sec_on = has_data = False
 	col_on = 0
 
-	for df in meta.fields:
+	for df, list_view_fields in get_render_layout(meta):
 		# on section break append previous section and html to doc html
 		if df.fieldtype == "Section Break":
 			if has_data and col_on and sec_on:
-				doc_html += section_html + html + "</div>"
+				doc_html.extend(section_html)
+				doc_html.extend(html)
+				doc_html.append("</div>")
 
 			elif has_data and not col_on and sec_on:
-				doc_html += """
+				doc_html.append(
+					"""
 					<br>
 					<div class='row'>
 						<div class='col-md-12 col-sm-12'>
@@ -825,18 +925,18 @@ def render_doc_as_html(doctype, docname, exclude_fields=None):
 						</div>
 					</div>
 				""".format(
-					section_label, section_html, html
+						section_label, "".join(section_html), "".join(html)
+					)
 				)
 
 			# close divs for columns
-			while col_on:
-				doc_html += "</div>"
-				col_on -= 1
+			doc_html.extend(["</div>"] * col_on)
 
 			sec_on = True
 			has_data = False
 			col_on = 0
-			section_html = html = ""
+			section_html.clear()
+			html.clear()
 
 			if df.label:
 				section_label = df.label
@@ -845,7 +945,8 @@ def render_doc_as_html(doctype, docname, exclude_fields=None):
 		# on column break append html to section html or doc html
 		if df.fieldtype == "Column Break":
 			if sec_on and not col_on and has_data:
-				section_html += """
+				section_html.append(
+					"""
 					<br>
 					<div class='row'>
 						<div class='col-md-12 col-sm-12'>
@@ -857,28 +958,31 @@ def render_doc_as_html(doctype, docname, exclude_fields=None):
 							{1}
 						</div>
 				""".format(
-					section_label, html
+						section_label, "".join(html)
+					)
 				)
 			elif col_on == 1 and has_data:
-				section_html += "<div class='col-md-4 col-sm-4'>" + html + "</div>"
+				section_html.append("<div class='col-md-4 col-sm-4'>" + "".join(html) + "</div>")
 			elif col_on > 1 and has_data:
-				doc_html += "<div class='col-md-4 col-sm-4'>" + html + "</div>"
+				doc_html.append("<div class='col-md-4 col-sm-4'>" + "".join(html) + "</div>")
 			else:
-				doc_html += """
+				doc_html.append(
+					"""
 					<div class='row'>
 						<div class='col-md-12 col-sm-12'>
 							{0}
 						</div>
 					</div>
 				""".format(
-					html
+						"".join(html)
+					)
 				)
 
-			html = ""
+			html.clear()
 			col_on += 1
 
 			if df.label:
-				html += "<br>" + df.label
+				html.append("<br>" + df.label)
 			continue
 
 		# on table iterate through items and create table
@@ -888,71 +992,92 @@ def render_doc_as_html(doctype, docname, exclude_fields=None):
 			items = doc.get(df.fieldname)
 			if not items:
 				continue
-			child_meta = frappe.get_meta(df.options)
 
 			if not has_data:
 				has_data = True
-			table_head = table_row = ""
-			create_head = True
-
-			for item in items:
-				table_row += "<tr>"
-				for cdf in child_meta.fields:
-					if cdf.in_list_view:
-						if create_head:
-							table_head += "<th class='text-muted'>" + cdf.label + "</th>"
-						if item.get(cdf.fieldname):
-							table_row += "<td>" + cstr(item.get(cdf.fieldname)) + "</td>"
-						else:
-							table_row += "<td></td>"
-
-				create_head = False
-				table_row += "</tr>"
+			table_head = "".join(
+				"<th class='text-muted'>" + cdf.label + "</th>" for cdf in list_view_fields
+			)
+			table_row = "".join(
+				"<tr>"
+				+ "".join(
+					"<td>" + cstr(item.get(cdf.fieldname) or "") + "</td>" for cdf in list_view_fields
+				)
+				+ "</tr>"
+				for item in items
+			)
 
 			if sec_on:
-				section_html += """
+				section_html.append(
+					"""
 					<table class='table table-condensed bordered'>
 						{0} {1}
 					</table>
 				""".format(
-					table_head, table_row
+						table_head, table_row
+					)
 				)
 			else:
-				html += """
+				html.append(
+					"""
 					<table class='table table-condensed table-bordered'>
 						{0} {1}
 					</table>
 				""".format(
-					table_head, table_row
+						table_head, table_row
+					)
 				)
 			continue
 
 		# on any other field type add label and value to html
-		if (
-			not df.hidden
-			and not df.print_hide
-			and doc.get(df.fieldname)
-			and df.fieldname not in exclude_fields
-		):
-			formatted_value = format_value(doc.get(df.fieldname), meta.get_field(df.fieldname), doc)
-			html += "<br>{0} : {1}".format(df.label or df.fieldname, formatted_value)
+		if doc.get(df.fieldname) and df.fieldname not in exclude_fields:
+			formatted_value = format_value(doc.get(df.fieldname), df, doc)
+			html.append("<br>{0} : {1}".format(df.label or df.fieldname, formatted_value))
 
 			if not has_data:
 				has_data = True
 
 	if sec_on and col_on and has_data:
-		doc_html += section_html + html + "</div></div>"
+		doc_html.extend(section_html)
+		doc_html.extend(html)
+		doc_html.append("</div></div>")
 	elif sec_on and not col_on and has_data:
-		doc_html += """
+		doc_html.append(
+			"""
 			<div class='col-md-12 col-sm-12'>
 				<div class='col-md-12 col-sm-12'>
 					{0} {1}
 				</div>
 			</div>
 		""".format(
-			section_html, html
+				"".join(section_html), "".join(html)
+			)
 		)
-	return {"html": doc_html}
+	return {"html": "".join(doc_html)}
+
+
+def get_render_layout(meta):
+	"""
+	Fields of meta that render_doc_as_html renders, as (docfield, list view child docfields)
+	pairs, the latter set for Table fields only. Cached per doctype for the request
+	"""
+	if getattr(frappe.local, "healthcare_render_layouts", None) is None:
+		frappe.local.healthcare_render_layouts = {}
+
+	layouts = frappe.local.healthcare_render_layouts
+	if meta.name not in layouts:
+		layout = []
+		for df in meta.fields:
+			if df.fieldtype == "Table":
+				child_meta = frappe.get_meta(df.options)
+				layout.append((df, [cdf for cdf in child_meta.fields if cdf.in_list_view]))
+			elif df.fieldtype in ["Section Break", "Column Break"] or (
+				not df.hidden and not df.print_hide
+			):
+				layout.append((df, None))
+		layouts[meta.name] = layout
+
+	return layouts[meta.name]
 
 
 def update_address_links(address, method):
@@ -963,7 +1088,7 @@ def update_address_links(address, method):
 	if "Healthcare" not in frappe.get_active_domains():
 		return
 
-	patient_links = list(filter(lambda link: link.get("link_doctype") == "Patient", address.links))
+	patient_links = [link for link in address.links if link.link_doctype == "Patient"]
 
 	for link in patient_links:
 		customer = frappe.db.get_value("Patient", link.get("link_name"), "customer")
@@ -980,18 +1105,21 @@ def update_patient_email_and_phone_numbers(contact, method):
 		return
 
 	if contact.is_primary_contact and (contact.email_id or contact.mobile_no or contact.phone):
-		patient_links = list(filter(lambda link: link.get("link_doctype") == "Patient", contact.links))
+		patient_links = [link for link in contact.links if link.link_doctype == "Patient"]
 
 		for link in patient_links:
 			contact_details = frappe.db.get_value(
 				"Patient", link.get("link_name"), ["email", "mobile", "phone"], as_dict=1
 			)
+			updates = {}
 			if contact.email_id and contact.email_id != contact_details.get("email"):
-				frappe.db.set_value("Patient", link.get("link_name"), "email", contact.email_id)
+				updates["email"] = contact.email_id
 			if contact.mobile_no and contact.mobile_no != contact_details.get("mobile"):
-				frappe.db.set_value("Patient", link.get("link_name"), "mobile", contact.mobile_no)
+				updates["mobile"] = contact.mobile_no
 			if contact.phone and contact.phone != contact_details.get("phone"):
-				frappe.db.set_value("Patient", link.get("link_name"), "phone", contact.phone)
+				updates["phone"] = contact.phone
+			if updates:
+				frappe.db.set_value("Patient", link.get("link_name"), updates)
 
 
 def before_tests():
@@ -1045,136 +1173,170 @@ def validate_nursing_tasks(document):
 		"mandatory": 1,
 		"status": ["not in", ["Completed", "Cancelled"]],
 	}
-	tasks = frappe.get_all("Nursing Task", filters=filters)
+	tasks = frappe.get_all("Nursing Task", filters=filters, pluck="name")
 	if not tasks:
 		return True
 
-	frappe.throw(
-		_("Please complete linked Nursing Tasks before submission: {}").format(
-			", ".join(get_link_to_form("Nursing Task", task.name) for task in tasks)
-		)
-	)
+	task_links = ", ".join(get_link_to_form("Nursing Task", task) for task in tasks[:5])
+	if len(tasks) > 5:
+		task_links += " " + _("and {0} more").format(len(tasks) - 5)
+
+	frappe.throw(_("Please complete linked Nursing Tasks before submission: {}").format(task_links))
 
 
 @frappe.whitelist()
 def get_medical_codes(template_dt, template_dn, code_standard=None):
 	"""returns codification table from templates"""
-	filters = {"parent": template_dn, "parenttype": template_dt}
+	codification_table = frappe.qb.DocType("Codification Table")
+	query = (
+		frappe.qb.from_(codification_table)
+		.select(
+			codification_table.code_value,
+			codification_table.code,
+			codification_table.system,
+			codification_table.definition,
+			codification_table.code_system,
+		)
+		.where(
+			(codification_table.parent == template_dn)
+			& (codification_table.parenttype == template_dt)
+		)
+		.orderby(codification_table.modified, order=frappe.qb.desc)
+	)
 
 	if code_standard:
-		filters["code_system"] = code_standard
+		query = query.where(codification_table.code_system == code_standard)
 
-	return frappe.db.get_all(
-		"Codification Table",
-		filters=filters,
-		fields=[
-			"code_value",
-			"code",
-			"system",
-			"definition",
-			"code_system",
-		],
-	)
+	return query.run(as_dict=True)
 
 
 def company_on_trash(doc, method):
-	for su in frappe.get_all("Healthcare Service Unit", {"company": doc.name}):
-		service_unit_doc = frappe.get_doc("Healthcare Service Unit", su.get("name"))
-		service_unit_doc.flags.on_trash_company = True
-		service_unit_doc.delete()
+	# the company's whole service unit tree goes, so skip the per node nested set rebuild,
+	# gaps left in lft / rgt do not affect the remaining trees
+	service_units = frappe.get_all(
+		"Healthcare Service Unit", filters={"company": doc.name}, pluck="name"
+	)
+	if service_units:
+		# unlink addresses and contacts as delete_doc would
+		frappe.db.delete(
+			"Dynamic Link",
+			{"link_doctype": "Healthcare Service Unit", "link_name": ["in", service_units]},
+		)
+		frappe.db.delete("Healthcare Service Unit", {"name": ["in", service_units]})
 
 
 def create_sample_collection_and_observation(doc):
+	observation_templates = {}
+	for observation_template in frappe.get_all(
+		"Observation Template",
+		filters={"item": ["in", list({item.item_code for item in doc.items})]},
+		fields=[
+			"item",
+			"sample_type",
+			"sample",
+			"medical_department",
+			"container_closure_color",
+			"name",
+			"sample_qty",
+			"has_component",
+			"sample_collection_required",
+		],
+	):
+		observation_templates.setdefault(observation_template.item, observation_template)
+
+	if not observation_templates:
+		return
+
 	meta = frappe.get_meta("Sales Invoice Item", cached=True)
+	has_patient_field = meta.has_field("patient")
 	diag_report_required = False
-	data = []
+
+	service_requests = [
+		item.reference_dn
+		for item in doc.items
+		if item.get("reference_dt") == "Service Request" and item.get("reference_dn")
+	]
+	collected_service_requests = set()
+	if service_requests:
+		for doctype in ("Observation Sample Collection", "Sample Collection"):
+			collected_service_requests.update(
+				frappe.get_all(
+					doctype,
+					filters={"service_request": ["in", service_requests]},
+					pluck="service_request",
+				)
+			)
+
+	template_components = {}
+	grouped = defaultdict(list)
 	for item in doc.items:
 		# to set patient in item table if not set
-		if meta.has_field("patient") and not item.patient:
+		if has_patient_field and not item.patient:
 			item.patient = doc.patient
 
 		# ignore if already created from service request
-		if item.get("reference_dt") == "Service Request" and item.get("reference_dn"):
-			if frappe.db.exists(
-				"Observation Sample Collection", {"service_request": item.get("reference_dn")}
-			) or frappe.db.exists(
-				"Sample Collection", {"service_request": item.get("reference_dn")}
-			):
-				continue
+		if (
+			item.get("reference_dt") == "Service Request"
+			and item.get("reference_dn") in collected_service_requests
+		):
+			continue
 
-		template_id = frappe.db.exists("Observation Template", {"item": item.item_code})
-		if template_id:
-			temp_dict = {}
-			temp_dict["name"] = template_id
-			if meta.has_field("patient") and item.get("patient"):
-				temp_dict["patient"] = item.get("patient")
-				temp_dict["child"] = item.get("name")
-			data.append(temp_dict)
-
-	out_data = []
-	for d in data:
-		observation_template = frappe.get_value(
-			"Observation Template",
-			d.get("name"),
-			[
-				"sample_type",
-				"sample",
-				"medical_department",
-				"container_closure_color",
-				"name",
-				"sample_qty",
-				"has_component",
-				"sample_collection_required",
-			],
-			as_dict=True,
-		)
+		observation_template = observation_templates.get(item.item_code)
 		if observation_template:
-			observation_template["patient"] = d.get("patient")
-			observation_template["child"] = d.get("child")
-			out_data.append(observation_template)
-	if not meta.has_field("patient"):
-		sample_collection = create_sample_collection(doc, doc.patient)
-	else:
-		grouped = {}
-		for grp in out_data:
-			grouped.setdefault(grp.patient, []).append(grp)
-		if grouped:
-			out_data = grouped
-
-	for grp in out_data:
-		patient = doc.patient
-		if meta.has_field("patient") and grp:
-			patient = grp
-		if meta.has_field("patient"):
+			observation_template = observation_template.copy()
+			observation_template.pop("item")
+			observation_template["patient"] = None
+			observation_template["child"] = None
+			if has_patient_field and item.get("patient"):
+				observation_template["patient"] = item.get("patient")
+				observation_template["child"] = item.get("name")
+			# templates are grouped by patient, all under None if items have no patient field
+			grouped[observation_template.patient].append(observation_template)
+
+	if has_patient_field:
+		for patient, patient_templates in grouped.items():
+			patient = patient or doc.patient
 			sample_collection = create_sample_collection(doc, patient)
-			for obs in out_data[grp]:
+			for obs in patient_templates:
 				(sample_collection, diag_report_required,) = insert_observation_and_sample_collection(
-					doc, patient, obs, sample_collection, obs.get("child")
+					doc, patient, obs, sample_collection, obs.get("child"), template_components
 				)
-			if sample_collection and len(sample_collection.get("observation_sample_collection")) > 0:
-				sample_collection.save(ignore_permissions=True)
-
-			if diag_report_required:
-				insert_diagnostic_report(doc, patient, sample_collection.name)
-		else:
-			sample_collection, diag_report_required = insert_observation_and_sample_collection(
-				doc, patient, grp, sample_collection
+			save_sample_collection_and_diagnostic_report(
+				doc, patient, sample_collection, diag_report_required
 			)
+	else:
+		patient = doc.patient
+		sample_collection = create_sample_collection(doc, patient)
+		for patient_templates in grouped.values():
+			for grp in patient_templates:
+				sample_collection, diag_report_required = insert_observation_and_sample_collection(
+					doc, patient, grp, sample_collection, template_components=template_components
+				)
+
+		save_sample_collection_and_diagnostic_report(
+			doc, patient, sample_collection, diag_report_required
+		)
+
 
-	if not meta.has_field("patient"):
-		if sample_collection and len(sample_collection.get("observation_sample_collection")) > 0:
-			sample_collection.save(ignore_permissions=True)
+def save_sample_collection_and_diagnostic_report(
+	doc, patient, sample_collection, diag_report_required
+):
+	if sample_collection and len(sample_collection.get("observation_sample_collection")) > 0:
+		sample_collection.save(ignore_permissions=True)
 
-		if diag_report_required:
-			insert_diagnostic_report(doc, patient, sample_collection.name)
+	if diag_report_required:
+		insert_diagnostic_report(doc, patient, sample_collection.name)
 
 
 def create_sample_collection(doc, patient):
-	patient = frappe.get_doc("Patient", patient)
+	patient_details = frappe.db.get_value("Patient", patient, ["name", "dob", "sex"], as_dict=True)
+	if not patient_details:
+		frappe.throw(_("Patient {0} not found").format(patient), frappe.DoesNotExistError)
+
 	sample_collection = frappe.new_doc("Sample Collection")
-	sample_collection.patient = patient.name
-	sample_collection.patient_age = patient.get_age()
-	sample_collection.patient_sex = patient.sex
+	sample_collection.patient = patient_details.name
+	sample_collection.patient_age = format_age(patient_details.dob)
+	sample_collection.patient_sex = patient_details.sex
 	sample_collection.company = doc.company
 	sample_collection.referring_practitioner = doc.ref_practitioner
 	sample_collection.reference_doc = doc.doctype
@@ -1194,7 +1356,9 @@ def insert_diagnostic_report(doc, patient, sample_collection=None):
 		diagnostic_report.save(ignore_permissions=True)
 
 
-def insert_observation_and_sample_collection(doc, patient, grp, sample_collection, child=None):
+def insert_observation_and_sample_collection(
+	doc, patient, grp, sample_collection, child=None, template_components=None
+):
 	diag_report_required = False
 	if grp.get("has_component"):
 		diag_report_required = True
@@ -1207,9 +1371,11 @@ def insert_observation_and_sample_collection(doc, patient, grp, sample_collectio
 			child=child if child else "",
 		)
 
-		sample_reqd_component_obs, non_sample_reqd_component_obs = get_observation_template_details(
-			grp.get("name")
-		)
+		if template_components is None:
+			template_components = {}
+		if grp.get("name") not in template_components:
+			template_components[grp.get("name")] = get_observation_template_details(grp.get("name"))
+		sample_reqd_component_obs, non_sample_reqd_component_obs = template_components[grp.get("name")]
 		# create observation for non sample_collection_reqd grouped templates
 
 		if len(non_sample_reqd_component_obs) > 0:
@@ -1262,23 +1428,23 @@ def insert_observation_and_sample_collection(doc, patient, grp, sample_collectio
 	return sample_collection, diag_report_required
 
 
+BARCODE_WRITER_OPTIONS = {
+	"module_height": 3,
+	"text_distance": 0.9,
+	"write_text": False,
+}
+
+
 @frappe.whitelist()
-def generate_barcodes(in_val):
+def generate_barcodes(in_val, image_format="png"):
+	"""returns a base64 encoded Code128 barcode, as svg if image_format is "svg" else png"""
 	from io import BytesIO
 
 	from barcode import Code128
-	from barcode.writer import ImageWriter
-
-	stream = BytesIO()
-	Code128(str(in_val), writer=ImageWriter()).write(
-		stream,
-		{
-			"module_height": 3,
-			"text_distance": 0.9,
-			"write_text": False,
-		},
-	)
-	barcode_base64 = base64.b64encode(stream.getbuffer()).decode()
-	stream.close()
+	from barcode.writer import ImageWriter, SVGWriter
 
-	return barcode_base64
+	# svg is plain markup and skips PIL rendering and png compression
+	writer = SVGWriter() if image_format == "svg" else ImageWriter()
+	with BytesIO() as stream:
+		Code128(str(in_val), writer=writer).write(stream, BARCODE_WRITER_OPTIONS)
+		return base64.b64encode(stream.getvalue()).decode()